@@ -1,14 +1,30 @@
 import os
 import asyncio
+import atexit
 import logging
+import queue
+import re
+import signal
+import sqlite3
 import sys
-from typing import Dict
-
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from functools import partial
+from importlib.metadata import version
+from logging.handlers import QueueHandler, QueueListener
+from typing import Final
+
+import httpx
 from dotenv import load_dotenv
+from openai import AsyncOpenAI
 
-from telegram import Update
-from telegram.constants import ChatAction
+from telegram import Message, Update
+from telegram.error import BadRequest, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     ApplicationBuilder,
     CommandHandler,
@@ -17,30 +33,416 @@ from telegram.ext import (
     filters,
 )
 
-from agents import Agent, Runner, SQLiteSession
+from agents import (
+    Agent,
+    ModelSettings,
+    RunHooks,
+    Runner,
+    SQLiteSession,
+    set_default_openai_client,
+)
 from agents.mcp import MCPServerStdio
+from openai.types.responses import ResponseTextDeltaEvent
+
+try:
+    # event loop in C (libuv), più veloce su socket e pipe stdio
+    import uvloop
+except ImportError:  # es. su Windows uvloop non è disponibile
+    uvloop = None
 
 
 # ================== LOGGING ==================
 
+# I logger scrivono solo su una coda (niente I/O nell'event loop);
+# il vero StreamHandler gira nel thread del QueueListener.
+_log_queue: queue.Queue = queue.Queue(-1)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+)
+_log_listener = QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# il formato completo lo applica lo StreamHandler: qui solo il messaggio
+_log_queue_handler = QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO,
+    handlers=[_log_queue_handler],
 )
 logger = logging.getLogger(__name__)
 
 
+# ================== PROMPT AGENT ==================
+
+# Istruzioni dell'Agent: costanti, quindi costruite una sola volta all'import
+# (stessi byte ad ogni run -> il prefisso del prompt resta cacheabile lato OpenAI).
+_AGENT_INSTRUCTIONS: Final[str] = (
+    "Sei un assistente per la gestione ordini via Telegram.\n"
+    "- Parli in italiano.\n"
+    "- PER USARE I SERVIZI REST devi usare il tool MCP 'call_rest_service' con "
+    "il parametro `service_name` che corrisponde ESATTAMENTE a uno dei seguenti nomi:\n"
+    "  * create_order  -> per inserire un nuovo ordine\n"
+    "  * get_order     -> per leggere il dettaglio di un ordine\n"
+    "  * get_orders    -> per leggere una lista di ordini\n"
+    "  * get_price_list -> per leggere i prezzi\n"
+    "- Prima di chiamare `call_rest_service`, se hai dubbi, usa il tool MCP "
+    "  `list_rest_services` e scegli `service_name` dalla lista.\n"
+    "- Quando l'utente chiede prezzi, listini, costi degli articoli, "
+    "  DEVI chiamare `call_rest_service` con:\n"
+    "    service_name = \"get_price_list\"\n"
+    "    arguments.customer_code = codice cliente (se noto)\n"
+    "    arguments.article_code  = codice articolo (se chiede un articolo specifico)\n"
+    "- Se il risultato contiene prezzi generici (customer_id=null), "
+    "- Se l'utente dice 'inserisci un ordine', mappa internamente questa intenzione "
+    "  al servizio `create_order`.\n"
+    "- Quando ti servono più informazioni indipendenti (es. prezzi e dettaglio ordine), "
+    "  chiama tutti i tool necessari in un'unica risposta, così vengono eseguiti in parallelo.\n"
+)
+
+# Versione corta per le chat che hanno già usato i tool: senza le spiegazioni
+# discorsive, ma con la mappa intenzione -> servizio -> argomenti completa
+# (la chat potrebbe non aver mai usato, ad es., get_price_list).
+_FAST_AGENT_INSTRUCTIONS: Final[str] = (
+    "Sei un assistente per la gestione ordini via Telegram. Parli in italiano.\n"
+    "Servizi REST: tool MCP `call_rest_service` con `service_name` ESATTAMENTE tra:\n"
+    "  * create_order   -> inserire un ordine ('inserisci un ordine')\n"
+    "  * get_order      -> dettaglio di un ordine\n"
+    "  * get_orders     -> lista di ordini\n"
+    "  * get_price_list -> prezzi/listini: arguments.customer_code = codice cliente "
+    "(se noto), arguments.article_code = codice articolo (se specifico)\n"
+    "- Se hai dubbi su servizi o parametri usa il tool MCP `list_rest_services`.\n"
+    "- Chiama in un'unica risposta tutti i tool indipendenti che ti servono.\n"
+)
+
+# Chiamate a tool dopo le quali una chat passa all'Agent con prompt corto
+_FAST_MODE_TOOL_CALLS: Final[int] = 2
+
+
+class ChatMode(Enum):
+    """Quale Agent usare per una chat."""
+
+    GENERIC = "generic"          # prompt completo con la guida ai servizi
+    ORDERS_FAST = "orders_fast"  # prompt corto (_FAST_AGENT_INSTRUCTIONS)
+
+
+# ================== TESTI COMANDI ==================
+
+# Testi statici di /start e /help (Markdown V1: solo coppie di * bilanciate)
+_START_TEXT: Final[str] = (
+    "Ciao! 👋 Sono il tuo assistente ordini.\n\n"
+    "Puoi scrivere cose come:\n"
+    "- *Inserisci un nuovo ordine per il cliente 1234 con consegna il 20/11*\n"
+    "- *Mostrami lo stato dell'ordine 5678*\n"
+    "- *Che prezzi abbiamo per l'articolo ABC123?*\n\n"
+    "Scrivi in linguaggio naturale e penserò io a parlare con il gestionale. 😉"
+)
+
+_HELP_TEXT: Final[str] = (
+    "Posso aiutarti a:\n"
+    "- Inserire nuovi ordini\n"
+    "- Consultare lo stato avanzamento ordini\n"
+    "- Recuperare informazioni commerciali (prezzi, sconti, disponibilità)\n\n"
+    "Dimmi semplicemente cosa ti serve, ad esempio:\n"
+    "*Vorrei inserire un ordine per il cliente 90017863 per 10 pezzi di MP002.*"
+)
+
+
+# ================== SESSIONI SQLITE ==================
+
+# DB locale con la memoria delle conversazioni (una sessione per chat)
+_SESSIONS_DB: Final[str] = "sessions.db"
+
+# SharedSQLiteSession usa dettagli privati di SQLiteSession (attributi di
+# __init__, _init_db_for_connection, _is_memory_db/_lock nei metodi sync):
+# verificati solo su questa versione, pinnata in requirements.txt.
+_AGENTS_SDK_VERSION: Final[str] = "0.5.1"
+
+
+def _open_sessions_db(db_path: str) -> sqlite3.Connection:
+    """
+    Apre UNA sola connessione a 'sessions.db', condivisa da tutte le chat,
+    e crea lo schema dell'SDK una volta sola.
+    Tutte le letture/scritture delle chat passano da questa connessione e da
+    un unico lock (vedi SharedSQLiteSession), quindi sono serializzate: il
+    guadagno è non aprire connessioni per thread/sessione e fare meno fsync
+    (WAL + synchronous=NORMAL). Isolation level di default: ogni add_items
+    dell'SDK resta una sola transazione (un solo commit WAL per turno).
+    """
+    sdk_version = version("openai-agents")
+    if sdk_version != _AGENTS_SDK_VERSION:
+        raise RuntimeError(
+            f"SharedSQLiteSession è verificata su openai-agents {_AGENTS_SDK_VERSION}, "
+            f"installata {sdk_version}: ricontrollare agents/memory/sqlite_session.py"
+        )
+
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+
+    # tabelle e indici dell'SDK (CREATE ... IF NOT EXISTS + commit): istanza
+    # usa-e-getta solo per riusare il DDL privato dell'SDK 0.5.1
+    SharedSQLiteSession("", db_path, conn, threading.Lock())._init_db_for_connection(conn)
+    return conn
+
+
+class SharedSQLiteSession(SQLiteSession):
+    """
+    SQLiteSession che usa la connessione condivisa aperta da OrdersBot
+    invece di aprirne una nuova per ogni thread/sessione.
+
+    Non chiama super().__init__: aprirebbe (sull'event loop) una connessione
+    usa-e-getta e rieseguirebbe il DDL ad ogni nuova sessione; lo schema lo
+    crea _open_sessions_db all'avvio.
+
+    ATTENZIONE: replica gli attributi privati di SQLiteSession di
+    openai-agents 0.5.1 (vedi _AGENTS_SDK_VERSION): ad ogni aggiornamento
+    dell'SDK va riverificata.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        db_path: str,
+        connection: sqlite3.Connection,
+        lock: threading.Lock,
+        sessions_table: str = "agent_sessions",
+        messages_table: str = "agent_messages",
+    ) -> None:
+        self.session_id = session_id
+        self.db_path = db_path
+        self.sessions_table = sessions_table
+        self.messages_table = messages_table
+        self._local = threading.local()
+        self._connection = connection
+        # Nei metodi sync dell'SDK il lock vero (self._lock) si usa solo in
+        # modalità "connessione condivisa" (_is_memory_db); per i file crea un
+        # threading.Lock() nuovo ad ogni chiamata, che non esclude nulla.
+        # La nostra connessione è condivisa tra i worker di asyncio.to_thread:
+        # stesso lock per tutte le sessioni, così le transazioni non si mescolano.
+        self._lock = lock
+        self._is_memory_db = True
+
+    def _get_connection(self) -> sqlite3.Connection:
+        return self._connection
+
+    async def count_items(self) -> int:
+        """Numero di item in sessione (COUNT sull'indice, senza decodificare il JSON)."""
+
+        def _count_items_sync() -> int:
+            with self._lock:
+                row = self._connection.execute(
+                    f"SELECT COUNT(*) FROM {self.messages_table} WHERE session_id = ?",
+                    (self.session_id,),
+                ).fetchone()
+            return row[0]
+
+        return await asyncio.to_thread(_count_items_sync)
+
+    def close(self) -> None:
+        # La connessione è di OrdersBot: viene chiusa una sola volta allo shutdown.
+        pass
+
+
+# ================== FILTRI TELEGRAM ==================
+
+# Messaggi nuovi (non modifiche), di solo testo, non comandi e non vuoti:
+# gli scarti li fa PTB prima di invocare handle_message.
+_USER_TEXT_FILTER: Final = (
+    filters.UpdateType.MESSAGE
+    & filters.TEXT
+    & ~filters.COMMAND
+    & ~filters.Regex(r"^\s*$")
+)
+
+
+# ================== CHIAMATE ALL'AGENT ==================
+
+# Tentativi extra quando una run supera LLM_TIMEOUT_S (backoff 0.5 s -> 1 s)
+_LLM_RETRIES: Final[int] = 2
+_LLM_BACKOFF_S: Final[float] = 0.5
+
+
+class _ToolCallTracker(RunHooks):
+    """
+    Conta i tool MCP partiti durante una run.
+    Una run che ha già chiamato un tool (es. create_order) NON va ripetuta:
+    rischieremmo di inserire l'ordine due volte.
+    """
+
+    def __init__(self) -> None:
+        self.tool_calls = 0
+
+    async def on_tool_start(self, context, agent, tool) -> None:
+        self.tool_calls += 1
+
+
+# Tempo massimo concesso alle risposte in corso quando il bot si ferma
+_SHUTDOWN_TIMEOUT_S: Final[float] = 5.0
+
+
+# ================== RISPOSTE IN STREAMING ==================
+
+# Aggiorna il messaggio ogni ~40 caratteri nuovi, ma non più di una volta al
+# secondo per chat (limiti di Telegram sulle edit)
+_STREAM_FLUSH_CHARS: Final[int] = 40
+_STREAM_MIN_INTERVAL_S: Final[float] = 1.0
+
+
+# Markdown V1 di Telegram: le entità ben formate restano, i caratteri speciali
+# isolati (che farebbero fallire il parse lato Telegram) vengono escapati.
+# I modelli GPT scrivono **grassetto**/__corsivo__ (Markdown "standard"):
+# in V1 diventano *grassetto*/_corsivo_.
+# L'ordine conta: prima blocchi/codice, poi le coppie doppie, poi '_' dentro
+# le parole (customer_code), poi le coppie *...* _..._ [..](..), infine i
+# caratteri rimasti spaiati.
+_MD_UNSAFE = re.compile(
+    r"```.*?```"
+    r"|`[^`\n]+`"
+    r"|\*\*(?P<bold>[^*\n]+)\*\*"
+    r"|__(?P<italic>[^_\n]+)__"
+    r"|(?<=[^\W_])(?P<inword>_)(?=[^\W_])"
+    r"|\*[^*\n]+\*"
+    r"|_[^_\n]+_"
+    r"|\[[^\]\n]*\]\([^)\n]*\)"
+    r"|(?P<stray>[*_`\[])",
+    re.DOTALL,
+)
+
+
+def _escape_md_match(match: re.Match) -> str:
+    if match["bold"] is not None:
+        return f"*{match['bold']}*"
+    if match["italic"] is not None:
+        return f"_{match['italic']}_"
+    stray = match["inword"] or match["stray"]
+    return "\\" + stray if stray else match.group(0)
+
+
+def _safe_markdown(text: str) -> str:
+    """Rende `text` valido per parse_mode="Markdown" escapando i marcatori spaiati."""
+    return _MD_UNSAFE.sub(_escape_md_match, text)
+
+
+class _StreamingReply:
+    """
+    Risposta Telegram che cresce mentre l'Agent genera il testo:
+    un messaggio segnaposto modificato a blocchi con edit_text.
+    Le edit intermedie sono in testo semplice (il Markdown parziale
+    spesso non è valido), solo quella finale usa parse_mode="Markdown".
+    Le edit intermedie partono in background (una alla volta): la run
+    dell'Agent non aspetta Telegram dentro il suo timeout/slot del semaforo.
+    """
+
+    def __init__(self, message: Message) -> None:
+        self._message = message
+        self._reply: Message | None = None
+        self._text = ""
+        self._sent_len = 0
+        self._last_edit = 0.0
+        self._edit_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """Invia il messaggio segnaposto."""
+        self._reply = await self._message.reply_text("…")
+        self._last_edit = time.monotonic()
+
+    def reset(self) -> None:
+        """Scarta il testo accumulato (nuovo tentativo della run)."""
+        self._text = ""
+        self._sent_len = 0
+
+    def push(self, delta: str) -> None:
+        """Aggiunge un pezzo di testo e, se è il momento, avvia l'aggiornamento del messaggio."""
+        self._text += delta
+        now = time.monotonic()
+        if (
+            self._reply is None
+            or (self._edit_task is not None and not self._edit_task.done())
+            or len(self._text) - self._sent_len < _STREAM_FLUSH_CHARS
+            or now - self._last_edit < _STREAM_MIN_INTERVAL_S
+        ):
+            return
+
+        self._sent_len = len(self._text)
+        self._last_edit = now
+        self._edit_task = asyncio.create_task(self._edit(self._text))
+
+    async def _edit(self, text: str) -> None:
+        try:
+            await self._reply.edit_text(text)
+        except TelegramError:
+            # un'edit intermedia persa non è un problema: arriverà quella finale
+            logger.debug("Edit intermedia non riuscita", exc_info=True)
+
+    async def finish(self, text: str, parse_mode: str | None = "Markdown") -> None:
+        """
+        Scrive il testo definitivo. In Markdown il testo passa da _safe_markdown;
+        se Telegram lo rifiuta comunque si rimanda `text` originale, semplice
+        (senza i backslash aggiunti dall'escape).
+        """
+        formatted = _safe_markdown(text) if parse_mode == "Markdown" else text
+
+        if self._reply is None:
+            await self._message.reply_text(formatted, parse_mode=parse_mode)
+            return
+
+        # l'ultima edit intermedia non deve arrivare dopo quella finale
+        if self._edit_task is not None:
+            await self._edit_task
+
+        try:
+            await self._reply.edit_text(formatted, parse_mode=parse_mode)
+            return
+        except BadRequest as e:
+            if _is_not_modified(e):
+                return
+            if parse_mode is None:
+                raise
+
+        try:
+            await self._reply.edit_text(text)
+        except BadRequest as e:
+            # l'ultima edit intermedia mostrava già esattamente questo testo
+            if not _is_not_modified(e):
+                raise
+
+
+    async def fail(self, text: str) -> None:
+        """
+        Messaggio di errore (testo semplice). Se anche questo fallisce (es.
+        Telegram ancora in RetryAfter) lo si registra nel log, senza rilanciare.
+        """
+        try:
+            await self.finish(text, parse_mode=None)
+        except TelegramError:
+            logger.exception("Impossibile inviare il messaggio di errore")
+
+
+def _is_not_modified(error: BadRequest) -> bool:
+    """Telegram rifiuta le edit che non cambiano il testo del messaggio."""
+    return "not modified" in str(error).lower()
+
+
 class OrdersBot:
     """
     Bot Telegram che delega la logica ad un Agent OpenAI
     collegato ad un MCP server locale (ordini, listini, ecc.).
     """
 
-    def __init__(self, mcp_server: MCPServerStdio) -> None:
-        # Carica variabili da .env (OPENAI_API_KEY, TELEGRAM_BOT_TOKEN, ecc.)
-        load_dotenv()
-
-        self.telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
+    def __init__(
+        self,
+        mcp_server: MCPServerStdio,
+        telegram_token: str | None = None,
+        max_sessions: int | None = None,
+    ) -> None:
+        # Il .env lo carica main() una sola volta: qui si leggono solo
+        # i parametri espliciti o, in mancanza, le variabili d'ambiente
+        self.telegram_token = telegram_token or os.getenv("TELEGRAM_BOT_TOKEN")
         if not self.telegram_token:
             raise RuntimeError("TELEGRAM_BOT_TOKEN non impostato nelle variabili d'ambiente")
 
@@ -53,89 +455,132 @@ class OrdersBot:
         # ma passiamo direttamente l'istanza MCPServerStdio in mcp_servers.
         self.agent = Agent(
             name="OrderAssistant",
-            instructions=(
-                "Sei un assistente per la gestione ordini via Telegram.\n"
-                "- Parli in italiano.\n"
-                "- PER USARE I SERVIZI REST devi usare il tool MCP 'call_rest_service' con "
-                "il parametro `service_name` che corrisponde ESATTAMENTE a uno dei seguenti nomi:\n"
-                "  * create_order  -> per inserire un nuovo ordine\n"
-                "  * get_order     -> per leggere il dettaglio di un ordine\n"
-                "  * get_orders    -> per leggere una lista di ordini\n"
-                "  * get_price_list -> per leggere i prezzi\n"
-                "- Prima di chiamare `call_rest_service`, se hai dubbi, usa il tool MCP "
-                "  `list_rest_services` e scegli `service_name` dalla lista.\n"
-                "- Quando l'utente chiede prezzi, listini, costi degli articoli, "
-                "  DEVI chiamare `call_rest_service` con:\n"
-                "    service_name = \"get_price_list\"\n"
-                "    arguments.customer_code = codice cliente (se noto)\n"
-                "    arguments.article_code  = codice articolo (se chiede un articolo specifico)\n"
-                "- Se il risultato contiene prezzi generici (customer_id=null), "
-                "- Se l'utente dice 'inserisci un ordine', mappa internamente questa intenzione "
-                "  al servizio `create_order`.\n"
-            ),
+            instructions=_AGENT_INSTRUCTIONS,
 
             # IMPORTANTISSIMO: qui agganciamo il server MCP locale
             mcp_servers=[self.mcp_server],
-            # Se vuoi forzare SEMPRE l'uso di strumenti, puoi usare ModelSettings(tool_choice="required")
-            # model_settings=ModelSettings(tool_choice="required"),
+            # Più tool call indipendenti nello stesso turno: il Runner le esegue
+            # già in parallelo (asyncio.gather), basta permetterle al modello.
+            # Se vuoi forzare SEMPRE l'uso di strumenti, puoi aggiungere tool_choice="required"
+            model_settings=ModelSettings(parallel_tool_calls=True),
+        )
+
+        # Stesso Agent (tool, model settings) ma con le istruzioni corte,
+        # usato per le chat in modalità ORDERS_FAST
+        self.fast_agent = self.agent.clone(
+            name="OrderAssistantFast",
+            instructions=_FAST_AGENT_INSTRUCTIONS,
         )
 
-        # Sessioni per memorizzare la conversazione (una per chat Telegram)
-        self.sessions: Dict[int, SQLiteSession] = {}
+        # Sessioni per memorizzare la conversazione (una per chat Telegram).
+        # Cache LRU limitata: le chat inattive da più tempo vengono chiuse e scartate,
+        # la memoria resta comunque su 'sessions.db' e viene ricaricata al bisogno.
+        self.sessions: OrderedDict[int, SharedSQLiteSession] = OrderedDict()
+        if max_sessions is None:
+            max_sessions = int(os.getenv("MAX_SESSIONS", "512"))
+        self._max_sessions = max_sessions
+        # tool chiamati finora da ogni chat in cache (decide il ChatMode)
+        self._chat_tool_calls: dict[int, int] = {}
+
+        # Connessione unica (WAL) a 'sessions.db' condivisa da tutte le sessioni,
+        # con il lock che serializza le transazioni dei vari thread
+        self._sessions_db = _open_sessions_db(_SESSIONS_DB)
+        self._sessions_db_lock = threading.Lock()
+
+        # Timeout per singola run dell'Agent (poco sopra la latenza tipica)
+        self._llm_timeout = float(os.getenv("LLM_TIMEOUT_S", "12"))
+        # Massimo di run dell'Agent contemporanee (oltre si va comunque in 429)
+        self._llm_sem = asyncio.Semaphore(int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")))
+
+        # Micro-batching: i messaggi arrivati entro BATCH_WINDOW_MS vengono
+        # raccolti (max BATCH_MAX) e gestiti con una chiamata all'Agent per chat
+        # (update, is_reset): anche /reset passa dalla coda per restare in ordine
+        self._queue: asyncio.Queue[tuple[Update, bool]] = asyncio.Queue()
+        self._batch_max = int(os.getenv("BATCH_MAX", "8"))
+        self._batch_window = int(os.getenv("BATCH_WINDOW_MS", "50")) / 1000
+        # ultimo task di risposta per ogni chat (serializza le risposte della stessa chat)
+        self._chat_tasks: dict[int, asyncio.Task] = {}
+        # TUTTI i task di risposta ancora in corso (per lo shutdown ordinato)
+        self._inflight: set[asyncio.Task] = set()
 
         # Application di python-telegram-bot
         self.application: Application | None = None
 
     # ---------- utility sessione per chat ----------
 
-    def _get_session(self, chat_id: int) -> SQLiteSession:
+    def _new_session(self, chat_id: int) -> SharedSQLiteSession:
+        """Crea una sessione per la chat appoggiata alla connessione condivisa."""
+        return SharedSQLiteSession(
+            str(chat_id), _SESSIONS_DB, self._sessions_db, self._sessions_db_lock
+        )
+
+    def _get_session(self, chat_id: int) -> SharedSQLiteSession:
         """
         Ritorna (o crea) una sessione SQLite per quella chat.
         Così l'Agent si ricorda il contesto della conversazione.
         """
-        if chat_id not in self.sessions:
-            # usa un DB locale 'sessions.db'
-            self.sessions[chat_id] = SQLiteSession(str(chat_id), "sessions.db")
-        return self.sessions[chat_id]
+        session = self.sessions.get(chat_id)
+        if session is not None:
+            # chat usata di recente -> in fondo alla coda LRU
+            self.sessions.move_to_end(chat_id)
+            return session
+
+        if len(self.sessions) >= self._max_sessions:
+            # evict della chat meno recente
+            old_chat_id, old_session = self.sessions.popitem(last=False)
+            self._chat_tool_calls.pop(old_chat_id, None)
+            logger.info("Sessione chat %s rimossa dalla cache (LRU)", old_chat_id)
+            old_session.close()
+
+        # usa il DB locale 'sessions.db' tramite la connessione condivisa
+        session = self._new_session(chat_id)
+        self.sessions[chat_id] = session
+        return session
+
+    def _chat_mode(self, chat_id: int) -> ChatMode:
+        """GENERIC finché la chat non ha usato i tool almeno _FAST_MODE_TOOL_CALLS volte."""
+        if self._chat_tool_calls.get(chat_id, 0) >= _FAST_MODE_TOOL_CALLS:
+            return ChatMode.ORDERS_FAST
+        return ChatMode.GENERIC
 
     # ---------- handlers comandi ----------
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Gestisce /start"""
-        text = (
-            "Ciao! 👋 Sono il tuo assistente ordini.\n\n"
-            "Puoi scrivere cose come:\n"
-            "- *Inserisci un nuovo ordine per il cliente 1234 con consegna il 20/11*\n"
-            "- *Mostrami lo stato dell'ordine 5678*\n"
-            "- *Che prezzi abbiamo per l'articolo ABC123?*\n\n"
-            "Scrivi in linguaggio naturale e penserò io a parlare con il gestionale. 😉"
-        )
-        await update.message.reply_text(text, parse_mode="Markdown")
+        await update.message.reply_text(_START_TEXT, parse_mode="Markdown")
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Gestisce /help"""
-        text = (
-            "Posso aiutarti a:\n"
-            "- Inserire nuovi ordini\n"
-            "- Consultare lo stato avanzamento ordini\n"
-            "- Recuperare informazioni commerciali (prezzi, sconti, disponibilità)\n\n"
-            "Dimmi semplicemente cosa ti serve, ad esempio:\n"
-            "*Vorrei inserire un ordine per il cliente 90017863 per 10 pezzi di MP002.*"
-        )
-        await update.message.reply_text(text, parse_mode="Markdown")
+        await update.message.reply_text(_HELP_TEXT, parse_mode="Markdown")
 
     async def reset_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Resetta la memoria della conversazione per quella chat."""
+        """
+        Resetta la memoria della conversazione per quella chat.
+        Passa dalla stessa coda dei messaggi: il reset avviene solo dopo le
+        risposte ai messaggi arrivati prima (che altrimenti riscriverebbero
+        la sessione appena azzerata).
+        """
         if not update.message:
             return
 
-        chat_id = update.message.chat_id
-
-        if chat_id in self.sessions:
-            session = self.sessions[chat_id]
-            # pulizia contenuto sessione
-            await session.clear_session()
-            del self.sessions[chat_id]
+        await self._queue.put((update, True))
+
+    async def _reset_chat(
+        self,
+        chat_id: int,
+        update: Update,
+        previous: asyncio.Task | None = None,
+    ) -> None:
+        """Azzera la sessione della chat dopo il task di risposta precedente."""
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        # pulizia contenuto sessione (anche se la chat è già uscita dalla cache LRU,
+        # la conversazione è ancora salvata su 'sessions.db')
+        session = self.sessions.pop(chat_id, None) or self._new_session(chat_id)
+        self._chat_tool_calls.pop(chat_id, None)
+        await session.clear_session()
+        session.close()
 
         await update.message.reply_text(
             "✅ Ho azzerato la memoria della conversazione per questa chat."
@@ -144,37 +589,262 @@ class OrdersBot:
     # ---------- handler messaggi normali ----------
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Gestisce tutti i messaggi di testo non comandi."""
-        if not update.message or not update.message.text:
-            return
+        """
+        Gestisce tutti i messaggi di testo non comandi.
+        Non chiama subito l'Agent: accoda il messaggio per il micro-batching.
+        """
+        # _USER_TEXT_FILTER garantisce update.message con testo non vuoto
+        logger.info("Messaggio da %s: %s", update.message.chat_id, update.message.text)
 
-        user_message = update.message.text.strip()
-        chat_id = update.message.chat_id
+        await self._queue.put((update, False))
 
-        logger.info("Messaggio da %s: %s", chat_id, user_message)
+    # ---------- micro-batching messaggi ----------
 
-        # Mostra "sta scrivendo..."
-        await update.message.chat.send_action(ChatAction.TYPING)
+    async def _batch_worker(self) -> None:
+        """
+        Consuma la coda dei messaggi: raccoglie fino a BATCH_MAX messaggi arrivati
+        entro BATCH_WINDOW_MS e fa UNA sola chiamata all'Agent per ogni chat.
+        Così una raffica di messaggi dallo stesso utente costa un solo giro LLM.
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._batch_window
+
+            while len(batch) < self._batch_max:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # raggruppa per chat mantenendo l'ordine di arrivo; un /reset chiude
+            # il gruppo della sua chat: prima si risponde ai messaggi precedenti
+            by_chat: dict[int, list[Update]] = {}
+            for update, is_reset in batch:
+                chat_id = update.message.chat_id
+                if is_reset:
+                    if chat_id in by_chat:
+                        self._dispatch(chat_id, self._answer, by_chat.pop(chat_id))
+                    self._dispatch(chat_id, self._reset_chat, update)
+                else:
+                    by_chat.setdefault(chat_id, []).append(update)
+
+            for chat_id, updates in by_chat.items():
+                self._dispatch(chat_id, self._answer, updates)
+
+            for _ in batch:
+                self._queue.task_done()
+
+    def _dispatch(self, chat_id: int, handler, arg) -> None:
+        """
+        Avvia `handler(chat_id, arg, previous)` in un task. I task della stessa
+        chat restano in ordine: il nuovo aspetta quello precedente (stessa
+        sessione SQLite).
+        """
+        previous = self._chat_tasks.get(chat_id)
+        task = asyncio.create_task(handler(chat_id, arg, previous))
+        self._chat_tasks[chat_id] = task
+        task.add_done_callback(partial(self._forget_chat_task, chat_id))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    def _forget_chat_task(self, chat_id: int, task: asyncio.Task) -> None:
+        """Rimuove il task concluso se è ancora l'ultimo registrato per la chat."""
+        if self._chat_tasks.get(chat_id) is task:
+            del self._chat_tasks[chat_id]
+
+    async def _answer(
+        self,
+        chat_id: int,
+        updates: list[Update],
+        previous: asyncio.Task | None = None,
+    ) -> None:
+        """Risponde (con una sola chiamata all'Agent) ai messaggi raggruppati di una chat."""
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        # rispondiamo all'ultimo messaggio del gruppo
+        message = updates[-1].message
+        user_message = "\n".join(u.message.text for u in updates)
+
+        # Niente ChatAction.TYPING: il segnaposto "…" inviato subito fa già da
+        # indicatore, un sendChatAction in più consumerebbe solo budget Telegram
+        reply = _StreamingReply(message)
 
         try:
+            await reply.start()
             session = self._get_session(chat_id)
 
-            # Chiama l'Agent (che a sua volta userà MCP quando serve)
-            result = await Runner.run(
-                self.agent,
-                input=user_message,
-                session=session,
-            )
+            # Chiama l'Agent (che a sua volta userà MCP quando serve),
+            # il testo arriva all'utente man mano che viene generato
+            final_output = await self._run_agent(chat_id, user_message, session, reply)
+
+            reply_text = final_output or "Non ho ottenuto alcuna risposta dall'agent."
+            await reply.finish(reply_text)
 
-            reply_text = result.final_output or "Non ho ottenuto alcuna risposta dall'agent."
-            await update.message.reply_text(reply_text, parse_mode="Markdown")
+        except asyncio.CancelledError:
+            # shutdown: niente segnaposto "…" lasciato lì per sempre
+            await reply.fail("⚠️ Il bot si sta riavviando, riprova tra poco.")
+            raise
 
-        except Exception as e:
+        except Exception:
             logger.exception("Errore durante l'elaborazione del messaggio")
-            await update.message.reply_text(
+            await reply.fail(
                 "❌ Mi spiace, ho avuto un errore interno mentre processavo la tua richiesta."
             )
 
+    async def _run_agent(
+        self,
+        chat_id: int,
+        user_message: str,
+        session: SharedSQLiteSession,
+        reply: _StreamingReply,
+    ) -> str | None:
+        """
+        Esegue l'Agent in streaming (i delta di testo vanno in `reply`) e
+        ritorna il final_output.
+
+        Timeout (LLM_TIMEOUT_S, vedi _stream_agent: solo finché non arriva il
+        testo) e retry con backoff esponenziale: una richiesta bloccata viene
+        annullata e rilanciata invece di tenere ferma la chat.
+        Si ritenta solo se la run non ha ancora chiamato tool.
+        Il Runner salva l'input in sessione prima della prima chiamata al modello:
+        prima di ritentare si tolgono gli item scritti dal tentativo fallito,
+        altrimenti il messaggio dell'utente finirebbe più volte nella storia.
+        Le run contemporanee sono limitate da OPENAI_MAX_CONCURRENCY.
+        L'Agent (completo o corto) dipende dal ChatMode della chat.
+        """
+        if self._chat_mode(chat_id) is ChatMode.ORDERS_FAST:
+            agent = self.fast_agent
+        else:
+            agent = self.agent
+
+        # item in sessione prima della run (per il rollback dei tentativi falliti)
+        saved_items = await session.count_items()
+
+        attempt = 0
+        while True:
+            tracker = _ToolCallTracker()
+            try:
+                # il timeout parte solo dopo aver ottenuto lo slot del semaforo
+                async with self._llm_sem:
+                    final_output = await self._stream_agent(
+                        agent, user_message, session, reply, tracker
+                    )
+                if tracker.tool_calls and chat_id in self.sessions:
+                    self._chat_tool_calls[chat_id] = (
+                        self._chat_tool_calls.get(chat_id, 0) + tracker.tool_calls
+                    )
+                return final_output
+            except asyncio.TimeoutError:
+                if attempt >= _LLM_RETRIES or tracker.tool_calls:
+                    raise
+                await self._rollback_session(session, saved_items)
+                reply.reset()
+                delay = _LLM_BACKOFF_S * (2 ** attempt)
+                attempt += 1
+                logger.warning(
+                    "Timeout Agent dopo %.1fs, nuovo tentativo %d/%d tra %.1fs",
+                    self._llm_timeout, attempt, _LLM_RETRIES, delay,
+                )
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _rollback_session(session: SharedSQLiteSession, saved_items: int) -> None:
+        """Riporta la sessione a `saved_items` item (toglie i più recenti)."""
+        extra = await session.count_items() - saved_items
+        for _ in range(extra):
+            await session.pop_item()
+
+    async def _stream_agent(
+        self,
+        agent: Agent,
+        user_message: str,
+        session: SQLiteSession,
+        reply: _StreamingReply,
+        hooks: RunHooks,
+    ) -> str | None:
+        """
+        Una singola run in streaming: inoltra i delta di testo a `reply`.
+
+        Finché non arriva il primo delta di testo, ogni attesa tra un evento e
+        il successivo è limitata a LLM_TIMEOUT_S (asyncio.TimeoutError -> retry
+        in _run_agent). Una volta che il testo scorre la run non viene più
+        interrotta: le risposte lunghe (es. liste di get_orders) arrivano intere.
+        """
+        result = Runner.run_streamed(
+            agent,
+            input=user_message,
+            session=session,
+            hooks=hooks,
+        )
+        events = result.stream_events()
+        text_started = False
+        try:
+            while True:
+                try:
+                    if text_started:
+                        event = await anext(events)
+                    else:
+                        event = await asyncio.wait_for(anext(events), self._llm_timeout)
+                except StopAsyncIteration:
+                    break
+
+                if event.type == "raw_response_event" and isinstance(
+                    event.data, ResponseTextDeltaEvent
+                ):
+                    text_started = True
+                    reply.push(event.data.delta)
+        finally:
+            # timeout/cancellazione: ferma anche la run lato SDK
+            if not result.is_complete:
+                result.cancel()
+
+        return result.final_output
+
+    async def _drain(self, timeout: float) -> None:
+        """
+        Allo shutdown aspetta (al massimo `timeout` secondi) i messaggi ancora
+        in coda e le risposte in corso, così nessuna run viene interrotta a
+        metà di una scrittura su 'sessions.db'. Quelle oltre il limite vengono annullate.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        # asyncio.wait (non gather) per non cancellare i task allo scadere del timeout.
+        # Si guardano tutti i task, non solo l'ultimo per chat: annullare quello
+        # non fermerebbe i precedenti che sta aspettando.
+        pending = set(self._inflight)
+        if pending:
+            _, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - loop.time()))
+
+        if pending:
+            logger.warning("Shutdown: annullo %d risposte ancora in corso", len(pending))
+            for task in pending:
+                task.cancel()
+            # i task annullati chiudono ancora il loro segnaposto su Telegram
+            await asyncio.wait(pending, timeout=timeout)
+
+    def _close_sessions_db(self) -> None:
+        """
+        PRAGMA optimize + chiusura di 'sessions.db' sotto il lock condiviso:
+        un add_items/pop_item già partito in asyncio.to_thread (il task annullato
+        non ferma il thread) viene completato prima, non interrotto a metà.
+        """
+        with self._sessions_db_lock:
+            # aggiorna le statistiche del query planner prima di chiudere
+            self._sessions_db.execute("PRAGMA optimize")
+            self._sessions_db.close()
+
     # ---------- avvio bot ----------
 
     async def run(self) -> None:
@@ -186,6 +856,13 @@ class OrdersBot:
             self.application = (
                 Application.builder()
                 .token(self.telegram_token)
+                # pool di connessioni HTTP/2 riusate verso le API Telegram
+                .request(HTTPXRequest(connection_pool_size=64, http_version="2"))
+                # ogni update in un proprio task: i comandi non aspettano gli altri handler
+                .concurrent_updates(int(os.getenv("PTB_CONCURRENCY", "64")))
+                # segnaposto + edit + risposta finale per molte chat insieme: rispetta
+                # i flood limit di Telegram e ritenta da solo sui 429 (RetryAfter)
+                .rate_limiter(AIORateLimiter(max_retries=2))
                 .build()
             )
 
@@ -196,7 +873,7 @@ class OrdersBot:
 
             # Handler messaggi di testo
             self.application.add_handler(
-                MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message)
+                MessageHandler(_USER_TEXT_FILTER, self.handle_message)
             )
 
         app = self.application
@@ -206,19 +883,35 @@ class OrdersBot:
         await app.start()
         await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
 
+        # Consumer della coda messaggi (micro-batching verso l'Agent)
+        batch_worker = asyncio.create_task(self._batch_worker())
+
         logger.info("Bot in esecuzione (polling)…")
 
+        # Rimani in esecuzione finché il processo non viene interrotto:
+        # Ctrl+C cancella il task, SIGTERM (deploy/restart) imposta stop_event;
+        # in entrambi i casi si passa dallo spegnimento ordinato qui sotto
+        stop_event = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+        except NotImplementedError:
+            # es. Windows: add_signal_handler non è supportato
+            pass
+
         try:
-            # Rimani in esecuzione finché il processo non viene interrotto (Ctrl+C)
-            stop_event = asyncio.Event()
             await stop_event.wait()
+            logger.info("Ricevuto SIGTERM, chiusura in corso…")
         except (KeyboardInterrupt, SystemExit):
             logger.info("Ricevuto segnale di stop, chiusura in corso…")
         finally:
-            # Spegnimento ordinato
+            # Spegnimento ordinato: prima si smette di ricevere update,
+            # poi si completano le risposte in corso e solo dopo si chiude tutto
             await app.updater.stop()
             await app.stop()
+            await self._drain(_SHUTDOWN_TIMEOUT_S)
+            batch_worker.cancel()
             await app.shutdown()
+            await asyncio.to_thread(self._close_sessions_db)
             logger.info("Bot terminato correttamente.")
 
 
@@ -238,10 +931,20 @@ async def main() -> None:
     mcp_command = os.getenv("ORDERS_MCP_COMMAND", "python")
     mcp_script = os.getenv("ORDERS_MCP_SCRIPT", "orders_mcp_server.py")
 
+    # Client HTTP unico (HTTP/2 + keep-alive) per tutte le chiamate OpenAI
+    # dell'Agent: niente handshake TCP/TLS ripetuti ad ogni Runner.run
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=15,
+    )
+    set_default_openai_client(AsyncOpenAI(http_client=http_client))
+
     logger.info("Avvio MCPServerStdio: %s %s", mcp_command, mcp_script)
 
     # Il context manager avvia il processo MCP e lo chiude alla fine
-    async with MCPServerStdio(
+    # (e alla fine chiude anche il client HTTP)
+    async with http_client, MCPServerStdio(
         name="Orders MCP Server",
         params={
             "command": mcp_command,
@@ -249,7 +952,17 @@ async def main() -> None:
         },
         cache_tools_list=True,  # evita di richiedere i tool ad ogni run
     ) as orders_mcp_server:
+        # Pre-carica la lista dei tool (cache_tools_list) ora che nessuno aspetta:
+        # il primo messaggio utente non paga il round-trip tools/list su stdio
+        t0 = time.perf_counter()
+        tools = await orders_mcp_server.list_tools()
+        logger.info(
+            "Tool MCP in cache: %d (%.0f ms)",
+            len(tools), (time.perf_counter() - t0) * 1000,
+        )
+
         logger.info("MCP server avviato, creo il bot OrdersBot...")
+        # token e MAX_SESSIONS li legge OrdersBot dalle variabili d'ambiente
         bot = OrdersBot(mcp_server=orders_mcp_server)
 
         try:
@@ -262,6 +975,9 @@ async def main() -> None:
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Interruzione da tastiera, arresto bot...")
@@ -9,7 +9,7 @@ MCP server locale per gestione Ordini / info commerciali via REST.
     2) call_rest_service(service_name, arguments) -> chiama il REST corrispondente
 
 Da usare con il Python MCP SDK (FastMCP):
-    pip install "mcp[cli]" httpx
+    pip install "mcp[cli]" httpx orjson
 
 Per avviarlo in stdio:
     python orders_mcp_server.py
@@ -28,6 +28,7 @@ from dataclasses import dataclass, field
 from typing import Any, Dict, List, Optional
 
 import httpx
+import orjson
 import xml.etree.ElementTree as ET
 
 from mcp.server.fastmcp import FastMCP, Context
@@ -333,11 +334,12 @@ async def call_rest_service(
         await ctx.report_progress(1, 1)
 
         # Provo a interpretare come JSON, se possibile
+        # (orjson: parsing in C, conta sulle liste lunghe di get_orders)
         response_json: Optional[dict] = None
         response_text: Optional[str] = None
         try:
-            response_json = resp.json()
-        except Exception:
+            response_json = orjson.loads(resp.content)
+        except orjson.JSONDecodeError:
             response_text = resp.text
 
         ok = resp.status_code >= 200 and resp.status_code < 300